@@ -16,19 +16,25 @@
    limitations under the License.
 """
 import time
-from asyncio import iscoroutinefunction
+from math import floor
+from sys import intern
+from asyncio import iscoroutinefunction, get_running_loop, sleep, Lock, Queue, QueueEmpty, QueueFull
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime, timedelta, timezone
 from typing import List
-from os import path, mkdir
-from aiofiles.threadpool import _open as async_open
+from os import path, makedirs
 from sanic_plugin_toolkit import SanicPluginRealm, SanicPlugin
 from sanic_plugin_toolkit.context import SanicContext
 from sanic_plugin_toolkit.plugin import PluginAssociated
 from sanic import __version__ as sanic_version
+from sanic.log import logger
 from sanic.request import Request
 from sanic.response import HTTPResponse, StreamingHTTPResponse
 
-from .util import recursive_update, datetime_to_iso
+from .renderers import RENDERERS, LOGGED_HEADERS
+from .util import recursive_update, datetime_to_iso, datetime_to_second, strip_ipv6_brackets, w3c_datetime_utc
 from .version import __version__ as sanic_metrics_version
 
 try:
@@ -36,12 +42,90 @@ try:
 except ImportError:
     from multidict import CIMultiDict as MultiDict
 
-TRUTHS = {True, 1, 't', 'T', '1', "true", "TRUE", "True"}
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    from os import writev
+except ImportError:
+    # Not on Windows
+    writev = None
+
+# Compared against the lower-cased opt-in/out value, so any casing of these counts as true
+_TRUTHS_LOWER = frozenset({'t', 'true', '1', 'yes', 'on'})
+
+LOG_QUEUE_SIZE = 8192  # max log lines waiting for the flusher before requests start waiting on it
+LOG_BATCH_MIN = 64  # max log lines written per batch normally
+LOG_BATCH_MAX = 1024  # max log lines written per batch when the queue is backing up
+LOG_FLUSH_INTERVAL = 0.05  # seconds a small batch waits for more lines to arrive before being written
+LOG_FILES_MAX = 32  # max log files held open at once, the least recently written one is closed to make room
+LOG_FILENAMES_MAX = 256  # max resolved {host} filenames cached per day, the oldest one is dropped to make room
+IOV_MAX = 1024  # max lines handed to a single writev(), the usual Linux and BSD IOV_MAX
+
+# Every request's metrics/details dict has the same keys. Copying a prebuilt dict reuses its
+# key layout, and is quicker than growing an empty dict one key at a time.
+# Don't put mutable values in here, the copies are shallow.
+# The metrics templates only hold the keys that are filled in before the post_response hook sees the dict,
+# so a hook doesn't find placeholders for values that don't exist yet (status, bytes, timestamp_end, etc).
+# The datetime_start keys are only worked out when there is a hook.
+_METRICS_TEMPLATE = dict.fromkeys((
+    'timestamp_start', 'skip_response', 'skip_logging',
+    'method', 'reqbytes', 'reqversion', 'path', 'qs', 'headers', 'host', 'client',
+))
+_METRICS_TEMPLATE['skip_response'] = False
+_METRICS_TEMPLATE['skip_logging'] = False
+_METRICS_HOOK_TEMPLATE = dict.fromkeys((
+    'timestamp_start', 'skip_response', 'skip_logging', 'datetime_start', 'datetime_start_iso',
+    'method', 'reqbytes', 'reqversion', 'path', 'qs', 'headers', 'host', 'client',
+))
+_METRICS_HOOK_TEMPLATE['skip_response'] = False
+_METRICS_HOOK_TEMPLATE['skip_logging'] = False
+_DETAILS_TEMPLATE = dict.fromkeys(('reqbytes', 'host', 'reqversion', 'method', 'path', 'qs', 'remote_addr', 'headers'))
+
 
 class MetricsAssociated(PluginAssociated):
     pass
 
 
+@lru_cache(maxsize=32)
+def _resolve_opt(val, opt_type):
+    """
+    Turn the raw opt-in/out value from the request into the opt choice. There are only
+    a handful of distinct values in practice, so the result is memoized.
+    :param str|None val:
+    :param str opt_type:
+    :return:
+    :rtype: bool
+    """
+    if val is None:
+        val = True if opt_type == "out" else False
+    else:
+        # Query args and headers always come through as str. Nearly every client sends "1" or "true",
+        # so check those directly before lowercasing for the set lookup.
+        val = val == '1' or val == 'true' or (isinstance(val, str) and val.lower() in _TRUTHS_LOWER)
+    if opt_type == "out":
+        return False if val is False else True
+    return True if val is True else False
+
+
+def _context_dict(context):
+    """
+    The plain dict behind a SanicContext. Attribute and .get() access on the context itself runs through
+    several layers of Python code, reading its backing dict is far cheaper on the per-request path.
+    _inner() isn't public toolkit API, so if it ever goes away this falls back to the context, which supports
+    the same [], .get() and .update() use, only slower.
+    :param SanicContext context:
+    :return:
+    :rtype: dict|SanicContext
+    """
+    try:
+        inner = context._inner
+    except AttributeError:
+        return context
+    return inner()
+
 
 class SanicMetrics(SanicPlugin):
 
@@ -80,197 +164,397 @@ class SanicMetrics(SanicPlugin):
         config = self.default_config()
         recursive_update(config, kwargs)
         context.config = config
+        log = config.get('log', {})
+        renderer = None
+        filename = None
+        if log:
+            # Resolve the log line renderer once, rather than on every request
+            format = log['format'] = log.get('format', 'common').strip().lower()
+            renderer = RENDERERS.get(format, None)
+            if renderer is None:
+                raise NotImplementedError(f"Cannot log metrics for format {format}")
+            filename = log.get('filename', "access_{date:s}.txt")
+        # Bind the config sections and values the middleware needs, so the per-request
+        # path reads one context attribute rather than walking a chain of .get() calls.
+        opt = config.get('opt', {}) or {}
+        save_headers = config.get('save_headers', {})
+        context.cfg_log = log
+        context.cfg_hooks = config.get('hooks', {}) or {}
+        context.cfg_save_cookies = config.get('save_cookies', False)
+        context.opt_type = opt.get('type', 'in')
+        context.opt_method = opt_method = opt.get('method', 'args')
+        context.opt_key = opt.get('key', "X-Collect-Metrics" if opt_method == "headers" else "metrics")
+        context.log_format = log['format'] if log else None
+        context.log_renderer = renderer
+        context.log_filename = filename
+        context.log_remove_brackets = log.get('remove_ipv6_brackets', True) if log else True
+        # Most filename templates don't split on address family, so don't work it out per request unless needed
+        context.filename_needs_ipvx = filename is not None and "{ipvx" in filename
+        context.filename_needs_host = filename is not None and "{host" in filename
+        save_header_names = tuple(intern(k) for k, v in save_headers.items() if v) if save_headers else ()
+        # Hooks are stored as (fn, is_awaitable), or None, so the middlewares don't need to inspect them per request
+        hooks = context.cfg_hooks
+        pre_request_hook = hooks.get('pre_request', None)
+        post_response_hook = hooks.get('post_response', None)
+        context.hooks_pre = (pre_request_hook, iscoroutinefunction(pre_request_hook)) if pre_request_hook else None
+        context.hooks_post = \
+            (post_response_hook, iscoroutinefunction(post_response_hook)) if post_response_hook else None
+        has_hooks = bool(pre_request_hook or post_response_hook)
+        # With no log and no hooks, nothing ever reads the metrics, so the middlewares can bail straight away
+        context.collect_metrics = bool(log) or has_hooks
+        # Only the combined and w3c formats log headers, and only w3c logs request bytes. Hooks get to see
+        # the whole metrics dict though, so collect everything if any hook is set.
+        context.needs_headers = has_hooks or context.log_format in ("combined", "vcombined", "w3c")
+        context.needs_reqbytes = has_hooks or context.log_format == "w3c"
+        if not has_hooks:
+            # Nothing but the log line will look at the headers, so don't fetch the ones it doesn't use
+            save_header_names = tuple(k for k in save_header_names if k in LOGGED_HEADERS)
+        context.save_header_names = save_header_names
+        # Open log file handles, keyed on (filename, format), each stored with the date it was opened for.
+        # Kept in least recently written order, and capped at LOG_FILES_MAX, because a {host} filename
+        # template gets a new file for every distinct Host header a client sends.
+        context.log_files = OrderedDict()
+        # Locks for files being opened, so only one writer opens each. Dropped again when the file is closed.
+        context.log_locks = {}
+        # Log filenames resolved for the current date, keyed on (host, ipvx). ipvx is None if the template lacks it
+        context.filename_cache = {'date': None, 'file_date': None, 'filenames': OrderedDict()}
+        context.have_uvloop = uvloop is not None
+        # All blocking log file work goes through one thread, so appends stay in order. It only exists
+        # while the server is running, outside of that (None) the loop's default executor is used.
+        context.log_executor = None
+        # Log lines are queued up here for the background flusher, once the server is started
+        context.log_queue = None
+        context.log_flusher = None
 
     @classmethod
     def collect_headers(cls, request, context):
-        if request is None:
+        # The header names are fixed at registration, check them before touching the request at all
+        header_names = _context_dict(context)['save_header_names']
+        if not header_names or request is None:
             return {}
         h = request.headers  # type: MultiDict #Actually CIMultiDict, aliased in import
         if h is None:
             return {}
-        config = context.get('config', {})
-        sh = config.get('save_headers', {})
-        if sh is False:
-            return {}
-        ch = {}
-        for header_name, do_save in sh.items():
-            if not do_save:
-                continue
-            ch[header_name] = h.getall(header_name, [])
-        return ch
+        getall = h.getall
+        return {header_name: getall(header_name, []) for header_name in header_names}
 
     @classmethod
-    def get_opt(cls, request, context):
-        try:
-            private_request_context = context.for_request(request)
+    def get_opt(cls, request, context, private_request_context=None):
+        """
+        Whether metrics are being collected for this request, cached on the request context.
+        :param Request request:
+        :param SanicContext context:
+        :param private_request_context: this plugin's context for the request, if the caller already has it
+        :return:
+        """
+        if private_request_context is None:
+            try:
+                private_request_context = context.for_request(request)
+            except (AttributeError, LookupError):
+                private_request_context = None
+        if private_request_context is not None:
             opt_choice = private_request_context.get('opt_choice', None)
             if opt_choice is not None:
                 return opt_choice
-        except (AttributeError, LookupError):
-            private_request_context = None
-        config = context.get('config', {})
-        opt = config.get('opt', {})
-        opt_type = opt.get('type', 'in')
-        opt_method = opt.get('method', 'args')
+        opt_choice = cls._compute_opt(request, context)
+        if private_request_context is not None:
+            private_request_context['opt_choice'] = opt_choice
+        return opt_choice
+
+    @classmethod
+    def _compute_opt(cls, request, context):
+        """
+        Work out whether this request has opted in to (or out of) metrics. This is the slow path,
+        the middlewares cache the result on the request context as 'opt_choice'.
+        :param Request request:
+        :param SanicContext context:
+        :return:
+        """
+        settings = _context_dict(context)
+        opt_type = settings['opt_type']
+        opt_method = settings['opt_method']
         # opt_in = key and flag must be present using method to collect stats
         # opt_out = collect_status unless key and flag are present in stats
         if opt_method == "args":
-            opt_key = opt.get("key", "metrics")
-            val = request.args.getlist(opt_key, [None])[-1]
+            val = request.args.getlist(settings['opt_key'], [None])[-1]
         elif opt_method == "headers":
-            opt_key = opt.get("key", "X-Collect-Metrics")
-            val = request.headers.getall(opt_key, [None])[-1]
+            val = request.headers.getall(settings['opt_key'], [None])[-1]
         else:
             # opt_in/opt_out method not implemented
-            raise NotImplementedError("Opt-in/Out-out method {}".format(opt_method))
-        if val is None:
-            val = True if opt_type == "out" else False
-        else:
-            val = val in TRUTHS
-        if opt_type == "out":
-            opt_choice = False if val is False else True
-        else:
-            opt_choice = True if val is True else False
-        if private_request_context is not None:
-            private_request_context['opt_choice'] = opt_choice
-        return opt_choice
+            raise NotImplementedError(f"Opt-in/Out-out method {opt_method}")
+        return _resolve_opt(val, opt_type)
 
     @classmethod
     async def log_metrics(cls, metrics, context):
-        config = context.get('config', {})
-        log = config.get('log', {})
-        if not log:
+        settings = _context_dict(context)
+        if not settings['cfg_log']:
             return
-        format = log.get('format', 'common').strip().lower()
-        remove_ipv6_brackets = log.get('remove_ipv6_brackets', True)
-        log_str = ""
+        format = settings['log_format']
+        renderer = settings['log_renderer']
+        remove_ipv6_brackets = settings['log_remove_brackets']
         client = metrics.get('client', "0.0.0.0")
-        ipvx = "ipv6" if (client.startswith('[') or ":" in client) else "ipv4"
+        if settings['filename_needs_ipvx']:
+            # A v6 address can start with a digit too, so the ":" check can't be skipped for unbracketed addresses
+            ipvx = "ipv6" if (client[:1] == '[' or ":" in client) else "ipv4"
+        else:
+            ipvx = None
         if remove_ipv6_brackets:
-            client = client.lstrip('[').rstrip(']')
-        method = metrics.get('method', 'GET')
-        reqversion = metrics.get('reqversion', "1.0")
-        nbytes = int(metrics.get('bytes', 0))
-        status = int(metrics.get('status', 0))
-        dt = metrics.get('datetime_start', datetime.now(tz=timezone.utc))
+            client = strip_ipv6_brackets(client)
+        datetime_start = metrics.get('datetime_start', None)
+        if datetime_start is not None:
+            # The log line and file are dated by datetime_start, which a hook or override_metrics may have replaced.
+            # It is only there at all when a hook is set, otherwise use the raw epoch timestamp.
+            # Worked out exactly, rather than flooring the float from timestamp().
+            second = datetime_to_second(datetime_start)
+        else:
+            second = floor(metrics.get('timestamp_start', None) or time.time())
         host = metrics.get('host', "127.0.0.1")
         if remove_ipv6_brackets:
-            host = host.lstrip('[').rstrip(']')
-        urlpath = metrics.get('path', '/')
-        qs = metrics.get('qs')
-        if format in ("common", "combined", "vcommon", "vcombined"):
-            if format.startswith('v'):
-                no_colon_host = host.replace(":", "")
-                log_str += "{host:s}: ".format(host=no_colon_host)
-            client_rfc931 = metrics.get('client_rfc931', '-')
-            client_username = metrics.get('client_username', '-')
-            dt_string = dt.strftime("%d/%b/%Y:%H:%M:%S %z")
-            p = ""+urlpath
-            if qs:
-                p += qs
-            rq_string = "{m:s} {p:s} HTTP/{v:s}".format(m=method, p=p, v=reqversion)
-            log_str += "{client:s} {rfc931:s} {username:s} [{dt:s}] \"{rq:s}\" {status:d} {nbytes:d}"\
-                .format(client=client, username=client_username, rfc931=client_rfc931, dt=dt_string, rq=rq_string,
-                        status=status, nbytes=nbytes)
-            if format == "combined" or format == "vcombined":
-                headers = metrics.get('headers', {})
-                referrer = (headers.get('Referer', []) or [""])[-1]
-                user_agent = (headers.get('User-Agent', []) or [""])[-1]
-                cookies = metrics.get('cookies', None)
-                if cookies is False or cookies is None:
-                    log_str += " \"{ref:s}\" \"{ua:s}\"".format(ref=referrer, ua=user_agent)
+            host = strip_ipv6_brackets(host)
+        # second is whole seconds since the epoch. The formatted log and file dates are cached per second
+        # (and per day), so every request landing in the same second reuses the same strings.
+        data = renderer(metrics, client, host, second)
+        filename_cache = settings['filename_cache']
+        # Whole days since the epoch, in UTC
+        date_key = second // 86400
+        if filename_cache['date'] != date_key:
+            filename_cache['date'] = date_key
+            filename_cache['file_date'] = datetime.fromtimestamp(date_key * 86400, tz=timezone.utc).strftime("%Y%m%d")
+            filename_cache['filenames'] = OrderedDict()
+        file_date = filename_cache['file_date']
+        filenames = filename_cache['filenames']
+        # The Host header is client supplied, so only key on it when the template actually uses it
+        key = (host, ipvx) if settings['filename_needs_host'] else ipvx
+        try:
+            filename = filenames[key]
+        except LookupError:
+            # The filename template is user supplied, so this one has to stay as str.format.
+            # It only runs once per date for each key.
+            filename = settings['log_filename'].format(date=file_date, host=host, ipvx=ipvx)
+            if len(filenames) >= LOG_FILENAMES_MAX:
+                # Only a {host} template can get here, drop the oldest host to make room
+                filenames.popitem(last=False)
+            filenames[key] = filename
+        queue = settings['log_queue']
+        if queue is None:
+            # No background flusher running (server not started yet?), write it out now
+            await cls.write_log_lines(context, filename, format, file_date, [data])
+            return
+        item = (filename, format, file_date, data)
+        try:
+            queue.put_nowait(item)
+        except QueueFull:
+            await queue.put(item)
+        return
+
+    @classmethod
+    async def write_log_lines(cls, context, filename, format, file_date, lines):
+        f = await cls.get_log_file(context, filename, format, file_date)
+        if f is None:
+            return
+        loop = get_running_loop()
+        try:
+            await loop.run_in_executor(context.log_executor, cls.write_and_flush, f, lines)
+        except (OSError, ValueError) as e:
+            logger.error("Sanic-Metrics cannot write to log file %s: %s", filename, e)
+            # Drop the broken handle, it will get reopened on the next write
+            await cls.close_log_file(context, (filename, format))
+
+    @staticmethod
+    def write_and_flush(f, lines):
+        if writev is None:
+            # The buffered writer copies each line into its buffer, no need to join them into one big bytes first
+            f.writelines(lines)
+            f.flush()
+            return
+        # Anything still in the file's buffer (a new file's header) has to go out ahead of these lines
+        f.flush()
+        fd = f.fileno()
+        for i in range(0, len(lines), IOV_MAX):
+            chunk = lines[i:i + IOV_MAX]
+            # One gathering write for the whole chunk, straight from the line bytes
+            written = writev(fd, chunk)
+            if written < sum(map(len, chunk)):
+                # Short write (disk full, signal, etc), push out whatever is left the slow way
+                remaining = b"".join(chunk)[written:]
+                while remaining:
+                    remaining = remaining[f.raw.write(remaining):]
+
+    @classmethod
+    async def log_flusher(cls, context):
+        """
+        Background task which drains the log queue, and writes each batch of
+        queued lines to its log file in a single flush.
+        :param SanicContext context:
+        :return:
+        """
+        queue = context.log_queue
+        while True:
+            items = [await queue.get()]
+            if queue.qsize() < LOG_BATCH_MIN:
+                # Only a trickle of lines, give a few more the chance to arrive and share this write
+                await sleep(LOG_FLUSH_INTERVAL)
+            # Take bigger bites when we're falling behind
+            batch_size = LOG_BATCH_MAX if queue.qsize() > LOG_BATCH_MIN else LOG_BATCH_MIN
+            while len(items) < batch_size:
+                try:
+                    items.append(queue.get_nowait())
+                except QueueEmpty:
+                    break
+            batches = {}
+            for filename, format, file_date, data in items:
+                batch = batches.get((filename, format), None)
+                if batch is None:
+                    batches[(filename, format)] = (file_date, [data])
                 else:
-                    log_str += " \"{ref:s}\" \"{ua:s}\" \"{cookie:s}\""\
-                        .format(ref=referrer, ua=user_agent, cookie=cookies)
-        elif format == "w3c":
-            reqbytes = metrics.get('reqbytes', 0)
-            headers = metrics.get('headers', {})
-            time_taken = float(metrics.get('time_delta_ms', 0.0))
-            referrer = (headers.get('Referer', []) or [""])[-1].replace(" ", "+")
-            user_agent = (headers.get('User-Agent', []) or [""])[-1].replace(" ", "+")
-            dt_string = dt.strftime("%Y-%m-%d %H:%M:%S")
-            if qs is None:
-                qs = ""
-            #date time s-ip cs-method cs-uri-stem cs-uri-query cs-version cs-bytes c-ip cs(User-Agent) cs(Referrer) sc-status sc-version sc-bytes time-taken
-            log_str += "{dt:s} {host:s} {method:s} {p:s} {qs:s} HTTP/{reqvers:s} {reqbytes:d} {client:s} {user_agent:s} {referrer:s} {status:d} HTTP/1.1 {nbytes:d} {time_taken:f}" \
-                .format(dt=dt_string, host=host, method=method, p=urlpath, qs=qs, reqvers=reqversion, reqbytes=reqbytes, client=client,
-                        user_agent=user_agent, referrer=referrer, status=status, nbytes=nbytes, time_taken=time_taken)
-        else:
-            raise NotImplementedError("Cannot log metrics for format {}".format(format))
-        filename = log.get('filename', "access_{date:s}.txt")
-        file_date = dt.strftime("%Y%m%d")
-        filename = filename.format(date=file_date, host=host, ipvx=ipvx)
-        dirname = path.dirname(filename)
-        if dirname:
-            abs_dir = path.abspath(dirname)
-            if not path.exists(abs_dir):
+                    batch[1].append(data)
+            for (filename, format), (file_date, lines) in batches.items():
                 try:
-                    mkdir(abs_dir)
-                except:
-                    raise RuntimeError("Cannot create directory! {}".format(abs_dir))
-        if not path.exists(filename):
-            await cls.write_log_header(format, filename)
-
-        # Can't use Async-With here because I need this to work on Python 3.5
-        # So this is a very convoluted way of doing it.
-        f = None
+                    await cls.write_log_lines(context, filename, format, file_date, lines)
+                except Exception:
+                    # Don't let one bad file kill the flusher
+                    logger.exception("Sanic-Metrics failed to write log lines to %s", filename)
+            for _ in items:
+                queue.task_done()
+
+    @classmethod
+    async def start_log_flusher(cls, context, loop):
+        context.log_queue = Queue(maxsize=LOG_QUEUE_SIZE)
+        context.log_flusher = loop.create_task(cls.log_flusher(context))
+
+    @classmethod
+    async def stop_log_flusher(cls, context):
+        queue = context.get('log_queue', None)
+        flusher = context.get('log_flusher', None)
+        # New log lines get written directly from here on
+        context.log_queue = None
+        context.log_flusher = None
+        if queue is not None and flusher is not None and not flusher.done():
+            await queue.join()
+        if flusher is not None:
+            flusher.cancel()
+
+    @classmethod
+    async def get_log_file(cls, context, filename, format, file_date):
+        """
+        Get the cached open log file for this filename and format, opening it (and closing
+        any handles left over from a previous date) if it is not open yet.
+        :param SanicContext context:
+        :param str filename:
+        :param str format:
+        :param str file_date:
+        :return:
+        """
+        log_files = context.log_files
+        key = (filename, format)
         try:
-            # Buffering=0 is _way_ faster than buffering=1 or buffering=-1 on my computer
-            # still don't know why. Maybe my very fast nvme ssd?
-            # But we don't use that in case of async access collisions
-            f = await async_open(filename, "a+b", buffering=4096)
+            f = log_files[key][1]
+        except LookupError:
+            pass
+        else:
+            log_files.move_to_end(key)
+            return f
+        lock = context.log_locks.get(key, None)
+        if lock is None:
+            lock = context.log_locks[key] = Lock()
+        async with lock:
+            # Another writer may have opened it while we were waiting on the lock
+            entry = log_files.get(key, None)
+            if entry is not None:
+                return entry[1]
+            for old_key, (old_date, _) in list(log_files.items()):
+                if old_date != file_date:
+                    await cls.close_log_file(context, old_key)
+            while len(log_files) >= LOG_FILES_MAX:
+                await cls.close_log_file(context, next(iter(log_files)))
+            loop = get_running_loop()
+            f = None
             try:
-                await f.write(log_str.encode('utf-8')+b'\n')
+                f = await loop.run_in_executor(context.log_executor, cls.open_log_file, format, filename)
+            except OSError as e:
+                logger.error("Sanic-Metrics cannot open log file %s: %s", filename, e)
+                return None
             finally:
-                await f.close()
+                if f is None:
+                    # close_log_file never runs for a file that didn't open, so drop its lock here
+                    context.log_locks.pop(key, None)
+            entry = log_files.get(key, None)
+            if entry is not None:
+                # This key's lock was dropped by a close while we waited, and another writer got in first
+                await loop.run_in_executor(context.log_executor, f.close)
+                return entry[1]
+            log_files[key] = (file_date, f)
+        return f
+
+    @classmethod
+    def open_log_file(cls, format, filename):
+        """
+        Open a log file for appending, creating its directory and writing the
+        format's header first if the file is new (or empty). This is blocking, run it in the log executor.
+        :param str format:
+        :param str filename:
+        :return:
+        """
+        dirname = path.dirname(filename)
+        if dirname:
+            # A directory that can't be created raises OSError, reported by get_log_file like any failed open
+            makedirs(path.abspath(dirname), exist_ok=True)
+        f = open(filename, "ab", buffering=65536)
+        # Append mode starts at the end of the file, so the position doubles as an emptiness check
+        # without a separate stat() of the path.
+        if f.tell() == 0:
+            cls.write_log_header(format, f)
+        return f
+
+    @classmethod
+    async def close_log_file(cls, context, key):
+        context.log_locks.pop(key, None)
+        entry = context.log_files.pop(key, None)
+        if entry is None:
             return
-        except:
-            if f is not None and not f.closed:
-                await f.close()
-        return
+        f = entry[1]
+        if not f.closed:
+            await get_running_loop().run_in_executor(context.log_executor, f.close)
 
     @classmethod
-    async def write_log_header(cls, format, filename):
+    async def close_log_files(cls, context):
+        for key in list(context.log_files.keys()):
+            await cls.close_log_file(context, key)
+
+    @classmethod
+    def write_log_header(cls, format, f):
         if format in ("combined", "common", "vcombined", "vcommon"):
             return
         if format == "w3c":
-            header = '''\
-# Software: Sanic Web Server Framework {sanic_version:s} (Sanic-Metrics {sanic_metrics_version:s})
+            # Same hand-rolled UTC formatter as the log lines' date and time fields
+            now_date = w3c_datetime_utc(floor(time.time()))
+            # the fields are arranged to match the w3c log string format in GoAccess log parser
+            # "%d %t %^ %m %U %q %^ %^ %h %u %R %s %^ %^ %L",
+            # date, time, skip, method, request, q, skip, skip, remote_host, useragent, referrer, status, skip, skip, time_taken_ms
+            header = f'''\
+# Software: Sanic Web Server Framework {sanic_version!s} (Sanic-Metrics {sanic_metrics_version!s})
 # Version: 1.0
 # Date: {now_date:s}
 # Fields: date time s-ip cs-method cs-uri-stem cs-uri-query cs-version cs-bytes c-ip cs(User-Agent) cs(Referrer) sc-status sc-version sc-bytes time-taken
 '''
-            # the fields are arranged to match the w3c log string format in GoAccess log parser
-            # "%d %t %^ %m %U %q %^ %^ %h %u %R %s %^ %^ %L",
-            # date, time, skip, method, request, q, skip, skip, remote_host, useragent, referrer, status, skip, skip, time_taken_ms
-            now_date = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-            header = header.format(sanic_version=str(sanic_version), sanic_metrics_version=str(sanic_metrics_version),
-                                   now_date=now_date)
         else:
-            raise NotImplementedError("Cannot write logfile header for format {}".format(format))
-
-        # Can't use Async-With here because I need this to work on Python 3.5
-        # So this is a very convoluted way of doing it.
-        f = None
-        try:
-            # Buffering=0 is _way_ faster than buffering=1 or buffering=-1 on my computer
-            # still don't know why. Maybe my very fast nvme ssd?
-            f = await async_open(filename, "wb", buffering=4096)
-            try:
-                await f.write(header.encode('utf-8'))
-            finally:
-                await f.close()
-            return
-        except:
-            if f is not None and not f.closed:
-                await f.close()
+            raise NotImplementedError(f"Cannot write logfile header for format {format}")
+        f.write(header.encode('utf-8'))
 
     @classmethod
-    def get_details_from_request(cls, request, context):
-        details = {}
+    def get_details_from_request(cls, request, context, details=None):
+        """
+        Collect the request details used for metrics.
+        :param Request request:
+        :param SanicContext context:
+        :param details: dict-like to write the details into, eg the private request context. A new dict if None.
+        :return:
+        """
+        if details is None:
+            details = _DETAILS_TEMPLATE.copy()
         try:
             host = request.server_name
-        except:
+        except Exception:
             host = request.host
         try:
             remote_addr = request.remote_addr or request.ip
@@ -280,18 +564,22 @@ class SanicMetrics(SanicPlugin):
             req_version = request.version
         except (AttributeError, LookupError):
             req_version = "1.0"
-        headers = cls.collect_headers(request, context)
+        settings = _context_dict(context)
+        headers = cls.collect_headers(request, context) if settings['needs_headers'] else {}
         path = request.path
         qs = request.query_string
         if qs:
-            qs = "?{}".format(qs)
+            qs = f"?{qs}"
         else:
             qs = None
-        try:
-            body = request.body
-            reqbytes = len(body)
-            details['reqbytes'] = reqbytes
-        except (AttributeError, LookupError):
+        if settings['needs_reqbytes']:
+            try:
+                body = request.body
+                reqbytes = len(body)
+                details['reqbytes'] = reqbytes
+            except (AttributeError, LookupError):
+                details['reqbytes'] = 0
+        else:
             details['reqbytes'] = 0
         details['host'] = host
         details['reqversion'] = req_version
@@ -306,47 +594,59 @@ class SanicMetrics(SanicPlugin):
 sanic_metrics = instance = SanicMetrics()
 
 
+# The default args bind module globals the middlewares use on every request as locals, which are
+# quicker to look up than globals. They aren't for callers to pass.
 @sanic_metrics.middleware(attach_to='request', relative='pre', priority=2, with_context=True)
-async def metrics_pre_req(request, context):
+async def metrics_pre_req(request, context, _time=time.time, _sm=sanic_metrics, _ctx_dict=_context_dict):
     """
 
     :param Request request:
     :param SanicContext context:
     :return:
     """
-    time_pre = time.time()
+    # The values read here were all set directly on these contexts, so read and write their backing dicts,
+    # which is much cheaper than going through the contexts themselves.
+    settings = _ctx_dict(context)
+    if not settings['collect_metrics']:
+        return False
+    time_pre = _time()
 
     try:
         private_request_context = context.for_request(request)
     except (AttributeError, LookupError):
+        private_request_context = None
+    if private_request_context is None:
         # cannot get request context. Not on a valid request?
         return False
-    if not sanic_metrics.get_opt(request, context):
+    private_request_context = _ctx_dict(private_request_context)
+    opt_choice = private_request_context.get('opt_choice', None)
+    if opt_choice is None:
+        opt_choice = private_request_context['opt_choice'] = _sm._compute_opt(request, context)
+    if not opt_choice:
         # opted out of metrics
         return False
-    config = context.get('config', {})
-    hooks = config.get('hooks', {})
     my_metrics = {
         'time_pre': time_pre,
         'skip_request': False
     }
-    if hooks:
-        pre_request_hook = hooks.get('pre_request', None)
-        if pre_request_hook:
-            is_awaitable = iscoroutinefunction(pre_request_hook)
-            resp = pre_request_hook(request, context, my_metrics)
-            if is_awaitable:
-                await resp
+    pre_request_hook = settings['hooks_pre']
+    if pre_request_hook:
+        hook_fn, is_awaitable = pre_request_hook
+        resp = hook_fn(request, context, my_metrics)
+        if is_awaitable:
+            await resp
     skip_request = my_metrics.get('skip_request', False)
     if not skip_request:
-        details = sanic_metrics.get_details_from_request(request, context)
-        private_request_context.update(details)
+        _sm.get_details_from_request(request, context, private_request_context)
     private_request_context.update(my_metrics)
     return False
 
 
 @sanic_metrics.middleware(attach_to='response', relative='post', priority=2, with_context=True)
-async def metrics_post_resp(request, response, context):
+async def metrics_post_resp(request, response, context, _time=time.time, _sm=sanic_metrics,
+                            _template=_METRICS_TEMPLATE, _hook_template=_METRICS_HOOK_TEMPLATE,
+                            _fromts=datetime.fromtimestamp, _utc=timezone.utc, _iso=datetime_to_iso,
+                            _ctx_dict=_context_dict):
     """
 
     :param Request request:
@@ -354,32 +654,47 @@ async def metrics_post_resp(request, response, context):
     :param SanicContext context:
     :return:
     """
-    time_post = time.time()
-    if not sanic_metrics.get_opt(request, context):
-        # opted out of metrics
+    # Read the contexts' backing dicts directly, see metrics_pre_req
+    settings = _ctx_dict(context)
+    post_response_hook = settings['hooks_post']
+    if not settings['cfg_log'] and post_response_hook is None:
+        # Nothing is going to consume these metrics, don't bother working out the opt choice either
         return
+    time_post = _time()
     try:
         rctx = context.for_request(request)
-        time_pre = rctx.get("time_pre", None)
     except (AttributeError, LookupError):
+        rctx = None
+    if rctx is not None:
+        rctx = _ctx_dict(rctx)
+        opt_choice = rctx.get('opt_choice', None)
+        if opt_choice is None:
+            opt_choice = rctx['opt_choice'] = _sm._compute_opt(request, context)
+    else:
+        opt_choice = _sm._compute_opt(request, context)
+    if not opt_choice:
+        # opted out of metrics
+        return
+    if rctx is not None:
+        time_pre = rctx.get("time_pre", None)
+    else:
         # No request context. Must be a sanic 19.12+ route-not-found error.
         # We can work around this, just get the details now
-        req_metrics = sanic_metrics.get_details_from_request(request, context)
-        rctx = context.create_child_context(req_metrics)
+        req_metrics = _sm.get_details_from_request(request, context)
+        rctx = req_metrics
         time_pre = time_post
     if time_pre is None:
         # No time_pre? request_middleware probably didn't run, errored, or was cancelled. Skip metrics
         return
-    config = context.get('config', {})
-    do_cookies = config.get('save_cookies', False)
-    metrics = {
-        'timestamp_start': time_pre,
-        'skip_response': False,
-        'skip_logging': False,
-    }
-    datetime_pre = datetime.fromtimestamp(time_pre, tz=timezone.utc)
-    metrics["datetime_start"] = datetime_pre
-    metrics["datetime_start_iso"] = datetime_to_iso(datetime_pre)
+    do_cookies = settings['cfg_save_cookies']
+    metrics = _hook_template.copy() if post_response_hook else _template.copy()
+    metrics['timestamp_start'] = time_pre
+    if post_response_hook:
+        # The datetime objects and ISO strings are only there for hooks,
+        # the log renderers format straight from the epoch timestamps.
+        datetime_pre = _fromts(time_pre, tz=_utc)
+        metrics["datetime_start"] = datetime_pre
+        metrics["datetime_start_iso"] = _iso(datetime_pre)
     metrics['method'] = rctx.get('method', 'GET')
     metrics['reqbytes'] = rctx.get('reqbytes', 0)
     metrics['reqversion'] = rctx.get('reqversion', "1.0")
@@ -388,15 +703,11 @@ async def metrics_post_resp(request, response, context):
     metrics['headers'] = rctx.get('headers', {})
     metrics['host'] = rctx.get('host', "127.0.0.1")
     metrics['client'] = rctx.get('remote_addr', "0.0.0.0")
-    hooks = config.get('hooks', {})
-
-    if hooks:
-        post_response_hook = hooks.get('post_response', None)
-        if post_response_hook:
-            is_awaitable = iscoroutinefunction(post_response_hook)
-            resp = post_response_hook(request, response, context, metrics)
-            if is_awaitable:
-                await resp
+    if post_response_hook:
+        hook_fn, is_awaitable = post_response_hook
+        resp = hook_fn(request, response, context, metrics)
+        if is_awaitable:
+            await resp
     skip_response = metrics.get('skip_response', False)
     if response and not skip_response:
         metrics['status'] = response.status
@@ -407,32 +718,43 @@ async def metrics_post_resp(request, response, context):
         metrics['bytes'] = resp_bytes
 
         if do_cookies:
-            metrics['cookies'] = ";".join("{:s}={:s}".format(k,v) for k,v in response.cookies.items())
+            # The .cookies property creates (and attaches) an empty CookieJar if the handler didn't set any cookies.
+            # Look at what's there already first, and only fall back to the property on Sanic versions without it.
+            cookies = getattr(response, '_cookies', False)
+            if cookies is False:
+                cookies = response.cookies
+            # The jar holds Cookie (or Morsel) objects, both keep the bare value on .value
+            metrics['cookies'] = ";".join([f"{k}={v.value}" for k, v in cookies.items()]) if cookies else ""
         else:
             metrics['cookies'] = None
     else:
         metrics['status'] = 500
         metrics['bytes'] = 0
         metrics['cookies'] = None
-    try:
-        shared_context = context.shared
-        shared_request_context = shared_context.for_request(request)
-        override_metrics = shared_request_context.get('override_metrics', None)
-    except (AttributeError, LookupError):
-        override_metrics = None
+    override_metrics = None
+    shared_context = settings.get('shared', None)
+    if shared_context is not None:
+        try:
+            shared_request_context = shared_context.for_request(request)
+        except (AttributeError, LookupError):
+            shared_request_context = None
+        if shared_request_context is not None:
+            override_metrics = _ctx_dict(shared_request_context).get('override_metrics', None)
     if override_metrics:
         metrics.update(override_metrics)
     skip_logging = metrics.get('skip_logging', False)
-    # Last thing, collect final time
-    time_post = metrics.get('timestamp_end', None) or time.time()
+    # The end time was taken on the way in, the bookkeeping since then isn't part of the request.
+    # An override can still supply its own.
+    time_post = metrics.get('timestamp_end', None) or time_post
     metrics['timestamp_end'] = time_post
-    datetime_now = datetime.fromtimestamp(time_post, tz=timezone.utc)
-    metrics["datetime_end"] = datetime_now
-    metrics["datetime_end_iso"] = datetime_to_iso(datetime_now)
+    if post_response_hook:
+        datetime_now = _fromts(time_post, tz=_utc)
+        metrics["datetime_end"] = datetime_now
+        metrics["datetime_end_iso"] = _iso(datetime_now)
     time_delta_ms = (time_post - time_pre) * 1000.0
     metrics["time_delta_ms"] = time_delta_ms
     if not skip_logging:
-        await sanic_metrics.log_metrics(metrics, context)
+        await _sm.log_metrics(metrics, context)
     return False
 
 @sanic_metrics.listener("after_server_start")
@@ -441,3 +763,23 @@ def on_start(app, loop):
     if proxies_count is not None and proxies_count < 1:
         raise RuntimeError("Please set PROXIES_COUNT > 0 or None")
 
+
+@sanic_metrics.listener("after_server_start", with_context=True)
+async def on_after_start(app, loop, context):
+    if not context.have_uvloop or not isinstance(loop, uvloop.Loop):
+        # uvloop schedules the log executor's callbacks back onto the loop noticeably cheaper
+        logger.info("Sanic-Metrics is running on the default asyncio event loop, "
+                    "install and use uvloop for lower log writing overhead.")
+    context.log_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sanic-metrics-log")
+    await sanic_metrics.start_log_flusher(context, loop)
+
+
+@sanic_metrics.listener("before_server_stop", with_context=True)
+async def on_before_stop(app, loop, context):
+    await sanic_metrics.stop_log_flusher(context)
+    await sanic_metrics.close_log_files(context)
+    executor = context.log_executor
+    context.log_executor = None
+    if executor is not None:
+        # Everything it was given has been awaited already, so this doesn't hold up the loop
+        executor.shutdown(wait=True)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#
+"""
+   Copyright 2021 Ashley Sommer
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+from sys import intern
+
+from .util import clf_datetime_utc, w3c_datetime_utc
+
+# Interned, and the saved header names get interned at registration too, so looking these up in
+# the metrics headers dict matches on identity rather than comparing the strings.
+H_REFERER = intern("Referer")
+H_USER_AGENT = intern("User-Agent")
+
+# Each renderer takes the metrics dict, the (bracket-stripped) client and host, and the request start time in whole
+# epoch seconds, and returns one complete encoded log line. They use str.encode() with no arguments, which takes
+# the utf-8 fast path without the codec name lookup.
+
+
+def _common_line(metrics, client, second):
+    get = metrics.get
+    dt_string = clf_datetime_utc(second)
+    return f"{client} {get('client_rfc931', '-')} {get('client_username', '-')} [{dt_string}] " \
+           f"\"{get('method', 'GET')} {get('path', '/')}{get('qs') or ''} HTTP/{get('reqversion', '1.0')}\" " \
+           f"{int(get('status', 0)):d} {int(get('bytes', 0)):d}"
+
+
+def _combined_suffix(metrics):
+    get = metrics.get
+    headers = get('headers', {})
+    referrer = (headers.get(H_REFERER, []) or [""])[-1]
+    user_agent = (headers.get(H_USER_AGENT, []) or [""])[-1]
+    cookies = get('cookies', None)
+    if cookies is False or cookies is None:
+        return f" \"{referrer}\" \"{user_agent}\""
+    return f" \"{referrer}\" \"{user_agent}\" \"{cookies}\""
+
+
+def render_common(metrics, client, host, second):
+    return f"{_common_line(metrics, client, second)}\n".encode()
+
+
+def render_combined(metrics, client, host, second):
+    return f"{_common_line(metrics, client, second)}{_combined_suffix(metrics)}\n".encode()
+
+
+def render_vcommon(metrics, client, host, second):
+    no_colon_host = host.replace(":", "")
+    return f"{no_colon_host}: {_common_line(metrics, client, second)}\n".encode()
+
+
+def render_vcombined(metrics, client, host, second):
+    no_colon_host = host.replace(":", "")
+    return f"{no_colon_host}: {_common_line(metrics, client, second)}{_combined_suffix(metrics)}\n".encode()
+
+
+def render_w3c(metrics, client, host, second):
+    get = metrics.get
+    headers = get('headers', {})
+    referrer = (headers.get(H_REFERER, []) or [""])[-1].replace(" ", "+")
+    user_agent = (headers.get(H_USER_AGENT, []) or [""])[-1].replace(" ", "+")
+    dt_string = w3c_datetime_utc(second)
+    # date time s-ip cs-method cs-uri-stem cs-uri-query cs-version cs-bytes c-ip cs(User-Agent) cs(Referrer)
+    # sc-status sc-version sc-bytes time-taken
+    return f"{dt_string} {host} {get('method', 'GET')} {get('path', '/')} {get('qs') or ''} " \
+           f"HTTP/{get('reqversion', '1.0')} {get('reqbytes', 0):d} {client} {user_agent} {referrer} " \
+           f"{int(get('status', 0)):d} HTTP/1.1 {int(get('bytes', 0)):d} " \
+           f"{float(get('time_delta_ms', 0.0)):f}\n".encode()
+
+
+# The only saved headers any of the log formats read
+LOGGED_HEADERS = frozenset({H_REFERER, H_USER_AGENT})
+
+RENDERERS = {
+    "common": render_common,
+    "combined": render_combined,
+    "vcommon": render_vcommon,
+    "vcombined": render_vcombined,
+    "w3c": render_w3c,
+}
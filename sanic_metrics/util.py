@@ -1,27 +1,100 @@
 # -*- coding: utf-8 -*-
 #
 import collections.abc
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from time import gmtime
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_ONE_SECOND = timedelta(seconds=1)
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
 
 # https://stackoverflow.com/a/3233356/3121813
 def recursive_update(d, u):
+    if not any(isinstance(v, collections.abc.Mapping) for v in u.values()):
+        # Nothing nested to merge, a plain update does the same job
+        d.update(u)
+        return d
     for k, v in u.items():
         if isinstance(v, collections.abc.Mapping):
-            d[k] = recursive_update(d.get(k, {}), v)
+            existing = d.get(k, None)
+            if not isinstance(existing, collections.abc.MutableMapping):
+                # Missing, or a non-dict default (eg save_headers=False) being replaced with a dict
+                existing = {}
+            d[k] = recursive_update(existing, v)
         else:
             d[k] = v
     return d
 
+@lru_cache(maxsize=256)
+def clf_datetime_utc(second):
+    """
+    Common log format datetime, eg "10/Oct/2000:13:55:36 +0000", for a whole-second UTC epoch timestamp.
+    Formatted by hand from gmtime, skipping datetime construction and strftime's %b/%z handling.
+    :param int second:
+    :return:
+    """
+    tm = gmtime(second)
+    return "%02d/%s/%04d:%02d:%02d:%02d +0000" % (tm.tm_mday, _MONTHS[tm.tm_mon - 1], tm.tm_year,
+                                                   tm.tm_hour, tm.tm_min, tm.tm_sec)
+
+@lru_cache(maxsize=256)
+def w3c_datetime_utc(second):
+    """
+    W3C extended log format datetime, eg "2000-10-10 13:55:36", for a whole-second UTC epoch timestamp.
+    :param int second:
+    :return:
+    """
+    tm = gmtime(second)
+    return "%04d-%02d-%02d %02d:%02d:%02d" % (tm.tm_year, tm.tm_mon, tm.tm_mday, tm.tm_hour, tm.tm_min, tm.tm_sec)
+
+@lru_cache(maxsize=256)
+def iso_datetime_utc(second):
+    """
+    ISO 8601 datetime without the fraction or zone suffix, eg "2000-10-10T13:55:36", for a whole-second
+    UTC epoch timestamp.
+    :param int second:
+    :return:
+    """
+    tm = gmtime(second)
+    return "%04d-%02d-%02dT%02d:%02d:%02d" % (tm.tm_year, tm.tm_mon, tm.tm_mday, tm.tm_hour, tm.tm_min, tm.tm_sec)
+
+def strip_ipv6_brackets(addr):
+    """
+    "[::1]" -> "::1", anything not wrapped in brackets comes back untouched (and unallocated).
+    :param str addr:
+    :return:
+    """
+    if addr[:1] == '[' and addr[-1:] == ']':
+        return addr[1:-1]
+    return addr
+
+def datetime_to_second(_d):
+    """
+    Whole seconds since the epoch for a datetime, worked out exactly with timedelta arithmetic.
+    Flooring the float from timestamp() can round .999999 up into the next second for far-off dates.
+    A naive datetime is taken as local time, the same as timestamp() does.
+    :param datetime _d:
+    :return:
+    """
+    if _d.tzinfo is None:
+        _d = _d.astimezone(timezone.utc)
+    return (_d - _EPOCH) // _ONE_SECOND
+
 def datetime_to_iso(_d, include_micros=None):
     """
     :param datetime _d:
     :param bool include_micros:
     :return:
     """
-    _d = _d.astimezone(timezone.utc)
+    if _d.tzinfo is not timezone.utc:
+        # The middleware only hands over datetimes already in UTC, so this conversion is usually skipped
+        _d = _d.astimezone(timezone.utc)
+    micros = _d.microsecond
     if include_micros is None:
-        include_micros = _d.microsecond != 0
+        include_micros = micros != 0
+    # The date and time part comes from the per-second cache, only the fraction is formatted each call
+    base = iso_datetime_utc(datetime_to_second(_d))
     if include_micros:
-        return _d.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-    else:
-        return _d.strftime("%Y-%m-%dT%H:%M:%SZ")
+        return "%s.%06dZ" % (base, micros)
+    return base + "Z"